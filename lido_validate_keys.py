@@ -1,11 +1,28 @@
-import json
+import secrets
+import sqlite3
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
+from hashlib import sha256
+from itertools import chain
 from time import time
 
 import click
-import lido_sdk.config
 
-from web3 import Web3
-from lido_sdk import Lido
+# web3 and lido_sdk take most of the start up time, so they are imported
+# only where they are used, and `--help` or wrong arguments return at once.
+
+try:
+    # Optional, parses large input files several times faster
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# Amount of keys verified with a single multi-pairing
+VERIFY_BATCH_SIZE = 64
+ETH32 = 32 * 10 ** 9
+# Right half of DepositMessage SSZ tree: amount leaf and zero padding leaf
+DEPOSIT_AMOUNT_ROOT = sha256(ETH32.to_bytes(32, "little") + bytes(32)).digest()
 
 
 @click.group()
@@ -33,11 +50,36 @@ from lido_sdk import Lido
     required=False,
     help="Retries to make success call to RPC before exception will be raised.",
 )
+@click.option(
+    "--verified_keys_cache",
+    type=str,
+    required=False,
+    help="SQLite file to remember verified keys between runs, so they are not verified again.",
+)
 @click.pass_context
-def cli(ctx, rpc, multicall_max_bunch, multicall_max_workers, multicall_max_retries):
+def cli(ctx, rpc, multicall_max_bunch, multicall_max_workers, multicall_max_retries, verified_keys_cache):
     """CLI utility to load Node Operators keys from file or network and check for duplicates and invalid signatures."""
-    w3 = Web3(Web3.HTTPProvider(rpc))
-    chain_id = w3.eth.chainId
+    import lido_sdk.config
+    import requests
+    from requests.adapters import HTTPAdapter
+    from web3 import Web3
+    from web3.middleware import construct_simple_cache_middleware
+    from lido_sdk import Lido
+
+    multicall_max_workers = multicall_max_workers or lido_sdk.config.MULTICALL_MAX_WORKERS
+
+    # Keep-alive connections pool, big enough to be shared by all multicall workers
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=multicall_max_workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    w3 = Web3(Web3.HTTPProvider(rpc, session=session))
+    # RPC responses are used as plain values, no need to rewrap each of them
+    w3.middleware_onion.remove("attrdict")
+    # Chain id is requested by both CLI and SDK, but it's fetched from RPC only once
+    w3.middleware_onion.add(construct_simple_cache_middleware(dict, {"eth_chainId"}), "chain_id_cache")
+    chain_id = w3.eth.chain_id
 
     if chain_id == 5:
         from web3.middleware import geth_poa_middleware
@@ -46,13 +88,15 @@ def cli(ctx, rpc, multicall_max_bunch, multicall_max_workers, multicall_max_retr
     lido = Lido(
         w3,
         MULTICALL_MAX_BUNCH=multicall_max_bunch or lido_sdk.config.MULTICALL_MAX_BUNCH,
-        MULTICALL_MAX_WORKERS=multicall_max_workers or lido_sdk.config.MULTICALL_MAX_WORKERS,
+        MULTICALL_MAX_WORKERS=multicall_max_workers,
         MULTICALL_MAX_RETRIES=multicall_max_retries or lido_sdk.config.MULTICALL_MAX_RETRIES,
     )
 
     # Passing computed items as context to command functions
     ctx.ensure_object(dict)
+    ctx.obj["w3"] = w3
     ctx.obj["lido"] = lido
+    ctx.obj["verified_keys_cache"] = verified_keys_cache
 
 
 @cli.command("validate_network_keys")
@@ -67,10 +111,28 @@ def validate_network_keys(ctx, details):
 
     t1 = time()
 
-    lido: Lido = ctx.obj["lido"]
-    _load_base_data(lido, details)
-    _validate_keys(lido)
-    _find_duplicated_keys(lido)
+    lido = ctx.obj["lido"]
+    verified_keys_cache = ctx.obj["verified_keys_cache"]
+    verified_digests = _load_verified_digests(verified_keys_cache)
+
+    with ProcessPoolExecutor() as executor:
+        verification_params = _get_verification_params(ctx.obj["w3"])
+        verifications = []
+        pubkey_index = defaultdict(list)
+
+        def on_keys_fetched(keys):
+            # Fetched keys are verified in background while the next ones are fetched
+            verifications.extend(
+                _submit_keys_verification(executor, keys, verification_params, verified_digests)
+            )
+            _build_pubkey_index(keys, pubkey_index)
+
+        operators_by_index = _load_base_data(lido, details, on_keys_fetched)
+        _validate_keys(operators_by_index, verifications)
+
+    _save_verified_keys(verified_keys_cache, verifications, verification_params)
+
+    _find_duplicated_keys(operators_by_index, pubkey_index)
 
     total_time = time() - t1
     click.secho(f"Finished in {round(total_time, 2)} seconds.")
@@ -91,27 +153,49 @@ def validate_file_keys(ctx, file):
 
     # Loading variables from context
     lido = ctx.obj["lido"]
-    keys = []
 
     # Load and format JSON file
-    # Formatting eth2deposit cli input fields
-    input_raw = json.load(open(file))
-    for item in input_raw:
-        item["key"] = bytes.fromhex(item["pubkey"])
-        item["depositSignature"] = bytes.fromhex(item["signature"])
-        del item["pubkey"]
-        del item["signature"]
-        keys.append(item)
-
-    _load_base_data(lido)
-    _validate_keys(lido, keys)
-    _find_duplicated_keys(lido, keys)
+    with open(file, "rb") as input_file:
+        keys = _format_input_keys(json_loads(input_file.read()))
+
+    verified_keys_cache = ctx.obj["verified_keys_cache"]
+    verification_params = _get_verification_params(ctx.obj["w3"])
+
+    # File keys are verified in background while network data is fetched
+    with ProcessPoolExecutor() as executor:
+        verifications = _submit_keys_verification(
+            executor, keys, verification_params, _load_verified_digests(verified_keys_cache)
+        )
+        operators_by_index = _load_base_data(lido)
+        _validate_keys(operators_by_index, verifications)
+
+    _save_verified_keys(verified_keys_cache, verifications, verification_params)
+
+    _find_duplicated_keys(operators_by_index, _build_pubkey_index(chain(lido.keys, keys)))
 
     total_time = time() - t1
     click.secho(f"Finished in {round(total_time, 2)} seconds.")
 
 
-def _load_base_data(lido, show_details=False):
+def _format_input_keys(items):
+    """Formatting eth2deposit cli input fields to the same ones network keys have."""
+    return [
+        {**item, "key": _hex_to_bytes(item["pubkey"]), "depositSignature": _hex_to_bytes(item["signature"])}
+        for item in items
+    ]
+
+
+def _hex_to_bytes(value):
+    """Both plain and 0x prefixed hex strings are accepted."""
+    return bytes.fromhex(value[2:] if value.startswith("0x") else value)
+
+
+def _load_base_data(lido, show_details=False, on_keys_fetched=None):
+    """
+    Fetches operators and their keys into `lido`.
+
+    @return: Operators by their index, shared by the reports.
+    """
     click.secho("Start fetching data...", fg="green")
     operator_ids_list = lido.get_operators_indexes()
     click.secho(f"Operators count fetch done. Operators count: [{len(operator_ids_list)}]", fg="green")
@@ -131,67 +215,275 @@ def _load_base_data(lido, show_details=False):
 
     click.secho("--------", fg="green")
     click.secho("Fetch operator's keys...", fg="green")
-    keys = lido.get_operators_keys()
+    if on_keys_fetched is None:
+        # Nothing to overlap the fetch with, so keys are fetched in one call without idle workers between groups
+        keys = lido.get_operators_keys()
+    else:
+        keys = []
+        for operators in _group_operators(operators_details):
+            operators_keys = lido.get_operators_keys(operators)
+            on_keys_fetched(operators_keys)
+            keys.extend(operators_keys)
+    lido.keys = keys
     click.secho(f"Keys fetch done. Keys count: [{len(keys)}]", fg="green")
     if show_details:
+        operators_keys_count = Counter(key['operator_index'] for key in keys)
         for operator in operators_details:
-            operators_keys_count = sum(1 for key in keys if key['operator_index'] == operator['index'])
             click.secho(f"Index: [{operator['index'] : >2}]. "
                         f"Operator: [{operator['name']: <23}]. "
-                        f"Keys fetched: [{operators_keys_count: >4}].")
+                        f"Keys fetched: [{operators_keys_count[operator['index']]: >4}].")
 
     click.secho("--------", fg="green")
 
+    return {operator["index"]: operator for operator in operators_details}
+
+
+def _group_operators(operators):
+    """Splits operators into groups with enough keys for a full round of multicall workers."""
+    import lido_sdk.config
+
+    group_size = lido_sdk.config.MULTICALL_MAX_BUNCH * lido_sdk.config.MULTICALL_MAX_WORKERS
+    group, group_keys_count = [], 0
+
+    for operator in operators:
+        group.append(operator)
+        group_keys_count += operator["totalSigningKeys"]
+        if group_keys_count >= group_size:
+            yield group
+            group, group_keys_count = [], 0
 
-def _validate_keys(lido, keys=None):
+    if group:
+        yield group
+
+
+def _validate_keys(operators_by_index, verifications):
     click.secho("Validating keys...", fg="green")
-    invalid_keys = lido.validate_keys(keys)
+    invalid_keys = [batch[index] for batch, future in verifications for index in future.result()]
 
     if invalid_keys:
-        click.secho("Invalid keys found:", fg="red")
+        lines = ["Invalid keys found:"]
         for key in invalid_keys:
-            operator = next((op for op in lido.operators if op["index"] == key.get("operator_index", None)), None)
-            _print_key(key, operator)
+            lines.append(_format_key(key, operators_by_index.get(key.get("operator_index", None))))
+        # Report is written at once, it could be thousands of lines long
+        click.secho("\n".join(lines), fg="red")
     else:
         click.secho("No invalid keys found.", fg="red")
     click.secho("--------", fg="green")
 
 
-def _find_duplicated_keys(lido, keys=None):
-    click.secho("Search for duplicates...", fg="green")
+def _get_verification_params(w3):
+    from lido_sdk.contract import LidoContract
+    from lido_sdk.eth2deposit.ssz import compute_deposit_domain
+    from lido_sdk.network.type import GENESIS_FORK_VERSION, WITHDRAWAL_CREDENTIALS
 
-    if keys is None:
-        duplicated_keys = lido.find_duplicated_keys()
-    else:
-        duplicated_keys = lido.find_duplicated_keys([*lido.keys, *keys])
+    chain_id = w3.eth.chain_id
+    deposit_domain = compute_deposit_domain(GENESIS_FORK_VERSION[chain_id])
+    actual_credential = LidoContract.getWithdrawalCredentials(w3)[""]
+    # Used keys could be deposited with one of the previous withdrawal credentials
+    possible_credentials = [bytes.fromhex(cred[2:]) for cred in WITHDRAWAL_CREDENTIALS[chain_id]]
+    possible_credentials = [wc for wc in possible_credentials if wc != actual_credential]
 
-    if duplicated_keys:
-        click.secho("Duplicated keys found:", fg="red")
-        for dk in duplicated_keys:
-            click.secho("Pair:", fg="red")
+    return actual_credential, possible_credentials, deposit_domain
+
+
+def _submit_keys_verification(executor, keys, verification_params, verified_digests=frozenset()):
+    """
+    Same checks as `lido.validate_keys`, but signatures are verified in batches
+    with one multi-pairing each, and only failed batches are narrowed down to keys.
+    Keys with digest in `verified_digests` are known to be valid and skipped.
+
+    @return: List of (batch, future) pairs, each future resolves to indexes of invalid keys in the batch.
+    """
+    if verified_digests:
+        keys = [key for key in keys if _get_verification_digest(key, verification_params) not in verified_digests]
+
+    verifications = []
+    for offset in range(0, len(keys), VERIFY_BATCH_SIZE):
+        batch = keys[offset:offset + VERIFY_BATCH_SIZE]
+        batch_keys = [(key["key"], key["depositSignature"], key.get("used", False)) for key in batch]
+        verifications.append(
+            (batch, executor.submit(_executor_find_invalid_keys, (batch_keys, *verification_params)))
+        )
+
+    return verifications
+
+
+def _get_verification_digest(key, verification_params):
+    """
+    Identifies key verification by everything its result depends on.
+
+    @return: None for keys with malformed pubkey or signature length, they are never cached.
+    """
+    # Fields are hashed without separators, so they have to be of fixed lengths to be unambiguous
+    if len(key["key"]) != 48 or len(key["depositSignature"]) != 96:
+        return None
+
+    actual_credential, possible_credentials, deposit_domain = verification_params
+    credentials = [actual_credential, *possible_credentials] if key.get("used", False) else [actual_credential]
+    return sha256(b"".join([key["key"], key["depositSignature"], deposit_domain, *credentials])).digest()
 
-            operator = next((op for op in lido.operators if op["index"] == dk[0].get("operator_index", None)), None)
-            _print_key(dk[0], operator)
 
-            operator = next((op for op in lido.operators if op["index"] == dk[1].get("operator_index", None)), None)
-            _print_key(dk[1], operator)
+def _load_verified_digests(cache_file):
+    if cache_file is None:
+        return set()
+
+    with closing(sqlite3.connect(cache_file)) as connection:
+        connection.execute("CREATE TABLE IF NOT EXISTS verified_keys (digest BLOB PRIMARY KEY)")
+        return {digest for digest, in connection.execute("SELECT digest FROM verified_keys")}
+
+
+def _save_verified_keys(cache_file, verifications, verification_params):
+    if cache_file is None:
+        return
+
+    # Keys of malformed lengths are always invalid, so each saved key has a digest
+    digests = [
+        (_get_verification_digest(key, verification_params),)
+        for batch, future in verifications
+        for index, key in enumerate(batch)
+        if index not in future.result()
+    ]
+
+    # All digests are written in one transaction
+    with closing(sqlite3.connect(cache_file)) as connection, connection:
+        connection.executemany("INSERT OR IGNORE INTO verified_keys VALUES (?)", digests)
+
+
+def _executor_find_invalid_keys(data):
+    keys, actual_credential, possible_credentials, deposit_domain = data
+
+    items, items_indexes, invalid_indexes = [], [], []
+    for index, (pubkey, signature, used) in enumerate(keys):
+        # Points are decompressed once and reused by every verification attempt
+        points = _decompress_points(pubkey, signature)
+        if points is None:
+            invalid_indexes.append(index)
+            continue
+
+        credentials = [actual_credential, *possible_credentials] if used else [actual_credential]
+        items.append((*points, _compute_signing_roots(pubkey, credentials, deposit_domain)))
+        items_indexes.append(index)
+
+    invalid_indexes.extend(items_indexes[index] for index in _find_invalid_batch_items(items))
+    return sorted(invalid_indexes)
+
+
+def _decompress_points(pubkey, signature):
+    """Returns pubkey and signature points or None if any of them is malformed."""
+    from lido_sdk.blstverify.blst import P1_Affine, P2_Affine
+
+    # Wrong lengths are rejected before any curve arithmetic
+    if len(pubkey) != 48 or len(signature) != 96:
+        return None
+
+    try:
+        pubkey_point, signature_point = P1_Affine(pubkey), P2_Affine(signature)
+    except (RuntimeError, TypeError):
+        return None
+
+    # Infinite pubkey would fail the whole batch and force checking its keys one by one
+    if pubkey_point.is_inf():
+        return None
+
+    return pubkey_point, signature_point
+
+
+def _compute_signing_roots(pubkey, withdrawal_credentials, deposit_domain):
+    """
+    Same as `compute_signing_root(DepositMessage(...), deposit_domain)` from the SDK for each credential,
+    but merkleizes the DepositMessage directly with only the pubkey dependent hashes.
+    """
+    # Pubkey leaf is shared by all credentials
+    pubkey_root = sha256(pubkey + bytes(16)).digest()
+
+    signing_roots = []
+    for withdrawal_credential in withdrawal_credentials:
+        deposit_message_root = sha256(
+            sha256(pubkey_root + withdrawal_credential).digest() + DEPOSIT_AMOUNT_ROOT
+        ).digest()
+        signing_roots.append(sha256(deposit_message_root + deposit_domain).digest())
+
+    return signing_roots
+
+
+def _find_invalid_batch_items(items):
+    """Returns indexes of (pubkey, signature, messages) items with invalid signatures."""
+    if not items or _verify_items(items):
+        return []
+
+    # Batch failed, checking keys one by one to find the invalid ones
+    return [index for index, item in enumerate(items) if not _verify_items([item])]
+
+
+def _verify_items(items):
+    """True if all items are valid for the same withdrawal credential."""
+    for wc_index in range(max(len(messages) for _, _, messages in items)):
+        if all(len(messages) > wc_index for _, _, messages in items) and _verify_batch(
+            [(pubkey, signature, messages[wc_index]) for pubkey, signature, messages in items]
+        ):
+            return True
+    return False
+
+
+def _verify_batch(items):
+    from lido_sdk.blstverify.blst import BLST_SUCCESS, Pairing
+    from lido_sdk.blstverify.verifier import DST, HASH_OR_ENCODE
+
+    # Every signature is multiplied by a random non-zero scalar,
+    # so invalid signatures can't cancel each other out in the aggregate.
+    ctx = Pairing(HASH_OR_ENCODE, DST)
+    try:
+        for pubkey, signature, message in items:
+            scalar = (secrets.randbits(64) or 1).to_bytes(8, "little")
+            if ctx.mul_n_aggregate(pubkey, signature, scalar, message) != BLST_SUCCESS:
+                return False
+    except ValueError:
+        # blst raises on points it refuses to aggregate, e.g. infinite pubkey or point out of group
+        return False
+
+    ctx.commit()
+    return ctx.finalverify()
+
+
+def _build_pubkey_index(keys, pubkey_index=None):
+    """Maps each pubkey to all the keys that have it. Extends `pubkey_index` if it's provided."""
+    if pubkey_index is None:
+        pubkey_index = defaultdict(list)
+
+    for key in keys:
+        pubkey_index[key["key"]].append(key)
+    return pubkey_index
+
+
+def _find_duplicated_keys(operators_by_index, pubkey_index):
+    click.secho("Search for duplicates...", fg="green")
+
+    # Each group of keys sharing a pubkey is reported once
+    duplicated_keys = [same_keys for same_keys in pubkey_index.values() if len(same_keys) > 1]
+
+    if duplicated_keys:
+        lines = ["Duplicated keys found:"]
+        for same_keys in duplicated_keys:
+            lines.append(f"Duplicates: [{len(same_keys)}]")
+            for key in same_keys:
+                lines.append(_format_key(key, operators_by_index.get(key.get("operator_index", None))))
+        click.secho("\n".join(lines), fg="red")
     else:
         click.secho("No duplicated keys found", fg="red")
     click.secho("--------", fg="green")
 
 
-def _print_key(key, operator=None):
+def _format_key(key, operator=None):
     if operator is None:
-        click.secho(f"Key: [{key['key'].hex()}].", fg="red")
-    else:
-        key_used = 'USED' if key['used'] else 'NOT USED'
-        click.secho(
-            f"Key: [{key['key'].hex()}]. "
-            f"Operator: [{operator['name']}] (index: [{operator['index']}]) key index: [{key['index']}]. "
-            f"Key [{key_used}] - OP Active: Stacking Limit: [{operator['stakingLimit']}]. "
-            f"Key count used: [{operator['usedSigningKeys']}].",
-            fg="red",
-        )
+        return f"Key: [{key['key'].hex()}]."
+
+    key_used = 'USED' if key['used'] else 'NOT USED'
+    return (
+        f"Key: [{key['key'].hex()}]. "
+        f"Operator: [{operator['name']}] (index: [{operator['index']}]) key index: [{key['index']}]. "
+        f"Key [{key_used}] - OP Active: Stacking Limit: [{operator['stakingLimit']}]. "
+        f"Key count used: [{operator['usedSigningKeys']}]."
+    )
 
 
 if __name__ == "__main__":
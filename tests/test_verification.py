@@ -0,0 +1,99 @@
+"""
+Regression checks of the signature verification against the SDK.
+
+The CLI merkleizes deposit messages and verifies signatures in batches on its own,
+so both are compared with the per key SDK implementation it replaces.
+"""
+import unittest
+
+from lido_sdk.blstverify.blst import P1, P2, SecretKey
+from lido_sdk.blstverify.verifier import DST, verify
+from lido_sdk.eth2deposit.ssz import DepositMessage, compute_deposit_domain, compute_signing_root
+
+from lido_validate_keys import ETH32, _compute_signing_roots, _executor_find_invalid_keys
+
+DEPOSIT_DOMAIN = compute_deposit_domain(bytes.fromhex("00001020"))
+ACTUAL_CREDENTIAL = bytes.fromhex("010000000000000000000000b9d7934878b5fb9610b3fe8a5e441e8fad7e293f")
+OLD_CREDENTIAL = bytes.fromhex("009690e5d4472c7c0dbdf490425d89862535d2a52fb686333f3a0a9ff5d2125e")
+INFINITY_PUBKEY = b"\xc0" + bytes(47)
+
+
+def _make_key(seed, withdrawal_credential, used=False):
+    secret_key = SecretKey()
+    secret_key.keygen(seed.to_bytes(32, "little"))
+    pubkey = P1(secret_key).compress()
+    signing_root = compute_signing_root(
+        DepositMessage(pubkey=pubkey, withdrawal_credentials=withdrawal_credential, amount=ETH32),
+        DEPOSIT_DOMAIN,
+    )
+    signature = P2().hash_to(signing_root, DST.encode()).sign_with(secret_key).compress()
+    return pubkey, signature, used
+
+
+def _sdk_is_valid(pubkey, signature, used):
+    # SDK can't merkleize keys of other lengths, deposit contract rejects them as well
+    if len(pubkey) != 48 or len(signature) != 96:
+        return False
+
+    credentials = [ACTUAL_CREDENTIAL, OLD_CREDENTIAL] if used else [ACTUAL_CREDENTIAL]
+    for withdrawal_credential in credentials:
+        try:
+            signing_root = compute_signing_root(
+                DepositMessage(pubkey=pubkey, withdrawal_credentials=withdrawal_credential, amount=ETH32),
+                DEPOSIT_DOMAIN,
+            )
+            if verify(pubkey, signing_root, signature):
+                return True
+        except ValueError:
+            # SDK raises on points blst refuses to aggregate, e.g. infinity pubkey
+            pass
+    return False
+
+
+class TestSigningRoots(unittest.TestCase):
+    def test_same_as_sdk(self):
+        for seed in range(1, 9):
+            pubkey, _, _ = _make_key(seed, ACTUAL_CREDENTIAL)
+            credentials = [ACTUAL_CREDENTIAL, OLD_CREDENTIAL]
+
+            expected = [
+                compute_signing_root(
+                    DepositMessage(pubkey=pubkey, withdrawal_credentials=credential, amount=ETH32),
+                    DEPOSIT_DOMAIN,
+                )
+                for credential in credentials
+            ]
+            self.assertEqual(_compute_signing_roots(pubkey, credentials, DEPOSIT_DOMAIN), expected)
+
+
+class TestFindInvalidKeys(unittest.TestCase):
+    def test_same_as_sdk(self):
+        keys = [_make_key(seed, ACTUAL_CREDENTIAL) for seed in range(1, 13)]
+        # Signature of another key
+        keys[1] = (keys[1][0], keys[2][1], False)
+        # Used keys could be deposited with the old credential, but not the unused ones
+        keys[3] = _make_key(13, OLD_CREDENTIAL, used=True)
+        keys[4] = _make_key(14, OLD_CREDENTIAL)
+        # Malformed and infinity pubkeys
+        keys[5] = (keys[5][0][:47], keys[5][0][47:] + keys[5][1], False)
+        keys[6] = (bytes(48), keys[6][1], False)
+        keys[7] = (INFINITY_PUBKEY, keys[7][1], False)
+        keys[8] = (INFINITY_PUBKEY, b"\xc0" + bytes(95), True)
+        keys[9] = (keys[9][0], bytes(96), False)
+
+        expected = [index for index, key in enumerate(keys) if not _sdk_is_valid(*key)]
+        self.assertEqual(expected, [1, 4, 5, 6, 7, 8, 9])
+
+        found = _executor_find_invalid_keys((keys, ACTUAL_CREDENTIAL, [OLD_CREDENTIAL], DEPOSIT_DOMAIN))
+        self.assertEqual(found, expected)
+
+    def test_all_valid(self):
+        keys = [_make_key(seed, ACTUAL_CREDENTIAL) for seed in range(1, 9)]
+        keys.append(_make_key(9, OLD_CREDENTIAL, used=True))
+
+        found = _executor_find_invalid_keys((keys, ACTUAL_CREDENTIAL, [OLD_CREDENTIAL], DEPOSIT_DOMAIN))
+        self.assertEqual(found, [])
+
+
+if __name__ == "__main__":
+    unittest.main()